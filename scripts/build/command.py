@@ -20,14 +20,40 @@
 Functions and classes used to simplify the execution of commands.
 """
 
-import array
+import asyncio
+import contextlib
 import fcntl
-import io
+import functools
+import logging
 import os
 import os.path
+import re
+import select
 import selectors
+import stat
 import subprocess
-import termios
+import sys
+
+
+# Capacity that we try to set for the pipes used to read the output of
+# commands, and size of the reads, so that one read can drain a full pipe:
+_PIPE_SIZE = 1 << 20
+
+# Matches the data till the last new line character, used to find the end of
+# the last complete line without copying the data:
+_COMPLETE_LINES = re.compile(rb".*\n", re.DOTALL)
+
+
+def _log_enabled(log):
+    """
+    Checks if the given log will write informative messages. Loggers from the
+    `logging` module may have that level disabled, other loggers always write
+    them.
+    """
+    is_enabled_for = getattr(log, "isEnabledFor", None)
+    if is_enabled_for is None:
+        return True
+    return is_enabled_for(logging.INFO)
 
 
 class LineBuffer:
@@ -45,53 +71,71 @@ class LineBuffer:
         self._log = log
         self._stream = stream
 
-        # Create the buffer:
-        self._buffer = io.BytesIO()
+        # Create the buffer where we keep the last incomplete line:
+        self._buffer = bytearray()
+
+        # If there is no stream and the log will not write the lines then
+        # there is no need to process the data at all:
+        if stream is None and not _log_enabled(log):
+            self.write = self._discard
+            self.flush = self._discard
 
-    def _write_line(self, line):
+    def _discard(self, data=None):
         """
-        Writes the given line to the stream, or to the log if there is no
-        stream.
+        Discards the given data, used instead of the `write` and `flush`
+        methods when nobody will use the lines.
         """
-        if self._stream is not None:
-            self._stream.write(line)
-            self._stream.write(b"\n")
-        else:
-            self._log.info(line.decode("utf-8"))
 
     def write(self, data):
         """
-        Processes the given data.
+        Processes the given data. The data can be any bytes-like object, for
+        example a memory view of a buffer that will be reused after this
+        method returns.
         """
-        # Process all the new line characters that appear in the data:
-        while True:
-            index = data.find(b"\n")
-            if index == -1:
-                break
-            line = data[0:index]
-            data = data[index+1:]
-            pending = self._buffer.getvalue()
-            if pending:
-                line = pending + line
-                self._buffer.truncate(0)
-                self._buffer.seek(0, io.SEEK_SET)
-            self._write_line(line)
-
-        # If there is any remaining data then add it to the buffer:
-        if data:
-            self._buffer.write(data)
+        # Find the end of the last complete line. If there isn't any then the
+        # data only needs to be added to the buffer:
+        match = _COMPLETE_LINES.match(data)
+        if match is None:
+            self._buffer += data
+            return
+        end = match.end()
+
+        # Write all the complete lines with one single call, joining the first
+        # one with the pending incomplete line if needed. The log doesn't need
+        # the last new line character.
+        if self._stream is not None:
+            if self._buffer:
+                self._buffer += data[:end]
+                self._stream.write(self._buffer)
+                self._buffer.clear()
+            else:
+                self._stream.write(data[:end])
+        else:
+            if self._buffer:
+                self._buffer += data[:end-1]
+                text = self._buffer.decode("utf-8", "replace")
+                self._buffer.clear()
+            else:
+                text = str(data[:end-1], "utf-8", "replace")
+            self._log.info(text)
+
+        # The rest is an incomplete line, add it to the buffer:
+        self._buffer += data[end:]
 
     def flush(self):
         """
         Processes the remaining data that is not a complete line. This is
         intended to process the data at the end of the stream that may not end
-        with a line separator.
+        with a line separator. The stream gets the data exactly as it is, only
+        the log gets it as a complete line.
         """
-        line = self._buffer.getvalue()
-        if line:
-            self._write_line(line)
-            self._buffer.truncate(0)
-            self._buffer.seek(0, io.SEEK_SET)
+        if not self._buffer:
+            return
+        if self._stream is not None:
+            self._stream.write(self._buffer)
+            self._buffer.clear()
+        else:
+            self.write(b"\n")
 
 
 class Command:
@@ -110,6 +154,12 @@ class Command:
         self._env = env
         self._cwd = cwd
 
+        # Outputs of the evaluations that the caller marked as cacheable,
+        # indexed by arguments. The environment and working directory don't
+        # need to be part of the key because they are the same for all the
+        # evaluations done with this object.
+        self._eval_cache = {}
+
     def _args(self, args):
         """
         Calculates the complete list of arguments for this command, adding the
@@ -117,23 +167,101 @@ class Command:
         """
         return self._command + args
 
-    def _available(self, fd):
+    def _process(self, fd, buf, data):
+        """
+        Processes the data available in the given file descriptor. The file
+        descriptor must be in non blocking mode, as it is read till there is
+        no more data available. The data is read into the given bytearray,
+        which is reused for all the reads. Returns `True` if the end of the
+        data has been reached.
+        """
+        view = memoryview(data)
+        while True:
+            try:
+                count = os.readv(fd, [data])
+            except BlockingIOError:
+                return False
+            if count == 0:
+                return True
+            buf.write(view[:count])
+
+    def _can_splice(self, stream):
         """
-        Returns the amount of bytes that are available for read in the given
-        file descriptor.
+        Checks if the data read from a pipe can be moved directly to the given
+        stream using the `splice` system call. That is only possible when the
+        stream is a regular file and the system supports `splice`.
         """
-        holder = array.array("i", [0])
-        fcntl.ioctl(fd, termios.FIONREAD, holder)
-        return holder[0]
+        if stream is None or not hasattr(os, "splice"):
+            return False
+        return stat.S_ISREG(os.fstat(stream.fileno()).st_mode)
 
-    def _process(self, fd, buf):
+    def _splice(self, fd, stream):
         """
-        Processes the data available in the given file descriptor.
+        Moves the data available in the given file descriptor to the given
+        stream without copying it to user space. The file descriptor must be
+        in non blocking mode, and the stream must be a regular file. Returns
+        `True` if the end of the data has been reached.
         """
-        count = self._available(fd)
-        if count > 0:
-            data = os.read(fd, count)
-            buf.write(data)
+        while True:
+            try:
+                count = os.splice(
+                    fd,
+                    stream.fileno(),
+                    _PIPE_SIZE,
+                    flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK,
+                )
+            except BlockingIOError:
+                return False
+            if count == 0:
+                return True
+
+    def _handler(self, fd, stream, buf, data):
+        """
+        Returns the function that processes the data available in the given
+        file descriptor, either moving it directly to the stream or reading it
+        into the given bytearray and passing it to the line buffer. If moving
+        the data directly fails, for example because the file system doesn't
+        support it, the function switches to the line buffer.
+        """
+        process = functools.partial(self._process, fd, buf, data)
+        if not self._can_splice(stream):
+            return process
+        stream.flush()
+        splicing = True
+
+        def handler():
+            nonlocal splicing
+            if splicing:
+                try:
+                    return self._splice(fd, stream)
+                except OSError:
+                    splicing = False
+            return process()
+
+        return handler
+
+    def _poller(self):
+        """
+        Creates the object that we use to be notified when there is data to
+        read from the pipes. On Linux this is an epoll object, used directly
+        because the generic selectors add work for each event. Elsewhere it is
+        the default selector. Returns the object, the events that should be
+        used to register file descriptors, and a function that waits till some
+        of them are ready and returns them.
+        """
+        if hasattr(select, "epoll"):
+            poller = select.epoll()
+            return (
+                poller,
+                select.EPOLLIN,
+                lambda: [fd for fd, _ in poller.poll()],
+            )
+        poller = selectors.DefaultSelector()
+        return (
+            poller,
+            selectors.EVENT_READ,
+            lambda: [key.fd for key, _ in poller.select()],
+        )
 
     def _run(self, args, stdin, stdout, stderr):
         """
@@ -149,67 +277,123 @@ class Command:
         self._log.info(f"Running command {args}")
 
         # Create the pipes that we will use to read the output and errors
-        # generated by the command:
+        # generated by the command. When both go to the log there is no need to
+        # distinguish them, so the errors are written to the output pipe.
         out_reader, out_writer = os.pipe()
-        err_reader, err_writer = os.pipe()
+        pipes = [(out_reader, out_writer, stdout)]
+        if stdout is None and stderr is None:
+            err_writer = subprocess.STDOUT
+        else:
+            err_reader, err_writer = os.pipe()
+            pipes.append((err_reader, err_writer, stderr))
+
+        # Put the read side of the pipes in non blocking mode, so that we can
+        # drain them without first checking how much data is available:
+        for reader, _, _ in pipes:
+            flags = fcntl.fcntl(reader, fcntl.F_GETFL)
+            fcntl.fcntl(reader, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        # Try to enlarge the capacity of the output and error pipes, so that
+        # the process doesn't block writing while we are busy processing the
+        # data that it already wrote. This may fail if the size exceeds the
+        # limit configured in the system, and then we keep the default size.
+        # Versions of Python older than 3.10 don't have the constant, so on
+        # Linux we use the value from the Linux headers. Other systems don't
+        # support changing the capacity.
+        set_pipe_size = getattr(fcntl, "F_SETPIPE_SZ", None)
+        if set_pipe_size is None and sys.platform.startswith("linux"):
+            set_pipe_size = 1031
+        if set_pipe_size is not None:
+            for reader, _, _ in pipes:
+                try:
+                    fcntl.fcntl(reader, set_pipe_size, _PIPE_SIZE)
+                except OSError:
+                    pass
+
+        # Create the object that we will use to be notified when there is data
+        # to read from the pipes:
+        poller, events, wait = self._poller()
 
         # Create the buffers where we will store the output and generated by
-        # the command till we have complete lines that can then be processed:
-        out_buffer = LineBuffer(log=self._log, stream=stdout)
-        err_buffer = LineBuffer(log=self._log, stream=stderr)
-
-        # Create the selector that we will use to be notified when there is
-        # data to read from the pipes:
-        selector = selectors.DefaultSelector()
-        selector.register(out_reader, selectors.EVENT_READ, data=out_buffer)
-        selector.register(err_reader, selectors.EVENT_READ, data=err_buffer)
-
-        # Start the process:
-        process = subprocess.Popen(
-            args=args,
-            env=self._env,
-            cwd=self._cwd,
-            stdin=stdin,
-            stdout=out_writer,
-            stderr=err_writer,
-        )
-
-        # Wait till the process finishes, and meanwhile process the data coming
-        # from the command:
-        while True:
-            events = selector.select(timeout=0.1)
-            for key, _ in events:
-                self._process(key.fileobj, key.data)
-            if process.poll() is not None:
-                break
-
-        # We no longer need the selector:
-        selector.close()
+        # the command till we have complete lines that can then be processed.
+        # When the output goes to a regular file the data is usually moved
+        # directly from the pipe to the file, and the buffer is only used if
+        # that fails.
+        data = bytearray(_PIPE_SIZE)
+        buffers = []
+        handlers = {}
+        for reader, _, stream in pipes:
+            buf = LineBuffer(log=self._log, stream=stream)
+            buffers.append(buf)
+            handlers[reader] = self._handler(reader, stream, buf, data)
+            poller.register(reader, events)
+
+        # Start the process. Once it is started we close our copies of the
+        # write side of the pipes, so that we see the end of the data when the
+        # process finishes. Note that options like `preexec_fn`, `user` or
+        # `group` shouldn't be used here, as they prevent Python from starting
+        # the process with `vfork` instead of `fork`. If the process can't be
+        # started we also need to release the read side of the pipes and the
+        # poller.
+        try:
+            process = subprocess.Popen(
+                args=args,
+                env=self._env,
+                cwd=self._cwd,
+                stdin=stdin,
+                stdout=out_writer,
+                stderr=err_writer,
+            )
+        except BaseException:
+            poller.close()
+            for reader, _, _ in pipes:
+                os.close(reader)
+            raise
+        finally:
+            for _, writer, _ in pipes:
+                os.close(writer)
+
+        # Process the data coming from the command till we reach the end of
+        # all the pipes, which happens when the process finishes:
+        while handlers:
+            for fd in wait():
+                if handlers[fd]():
+                    poller.unregister(fd)
+                    del handlers[fd]
+
+        # We no longer need the poller and the pipes:
+        poller.close()
+        for reader, _, _ in pipes:
+            os.close(reader)
 
         # We need to actually wait for the process, to avoid a zombie:
         result = process.wait()
 
-        # After the process has finished there may still be some remaining data
-        # in the pipes that was written in the interval between we check for
-        # available data and we check if the process finished. We need to
-        # process that data now.
-        self._process(out_reader, out_buffer)
-        self._process(err_reader, err_buffer)
-
-        # Now that all the data has been processed we can close the pipes:
-        os.close(out_writer)
-        os.close(out_reader)
-        os.close(err_writer)
-        os.close(err_reader)
-
         # Flush the buffers to complete processing of potential last lines that
         # don't need with a new line character:
-        out_buffer.flush()
-        err_buffer.flush()
+        for buf in buffers:
+            buf.flush()
 
         # Return the the exit code of the command:
         return result
 
+    @contextlib.contextmanager
+    def _open(self, stdin, stdout, stderr):
+        """
+        Opens the input and output files with the given names, and returns
+        the file objects, or `None` for the names that are `None`. The files
+        are closed when the block finishes, regardless of any exception that
+        may be raised while running the process.
+        """
+        with contextlib.ExitStack() as stack:
+            files = []
+            for name, mode in ((stdin, "rb"), (stdout, "wb"), (stderr, "wb")):
+                if name is not None:
+                    files.append(stack.enter_context(open(name, mode)))
+                else:
+                    files.append(None)
+            yield files
+
     def run(self, args=[], stdin=None, stdout=None, stderr=None):
         """
         Executes the command with the given arguments and environment and
@@ -223,23 +407,82 @@ class Command:
         # Calculate the complete list of arguments:
         args = self._args(args)
 
-        # Open the input and output files and remember to close them regardless of any exception
-        # that may be raised while running the process:
-        try:
-            if stdin is not None:
-                stdin = open(stdin, "rb")
-            if stdout is not None:
-                stdout = open(stdout, "wb")
-            if stderr is not None:
-                stderr = open(stderr, "wb")
+        # Open the input and output files and run the process:
+        with self._open(stdin, stdout, stderr) as (stdin, stdout, stderr):
             return self._run(args, stdin, stdout, stderr)
-        finally:
-            if stdin is not None:
-                stdin.close()
-            if stdout is not None:
-                stdout.close()
-            if stderr is not None:
-                stderr.close()
+
+    async def _copy_async(self, reader, buf):
+        """
+        Reads the data from the given asynchronous stream reader till the end
+        and passes it to the given line buffer.
+        """
+        while True:
+            data = await reader.read(_PIPE_SIZE)
+            if not data:
+                break
+            buf.write(data)
+
+    async def _run_async(self, args, stdin, stdout, stderr):
+        """
+        Same as `_run`, but using the asyncio event loop to wait for the
+        process and its output, so that other commands can run at the same
+        time.
+        """
+        # Log the complete command that will be executed:
+        self._log.info(f"Running command {args}")
+
+        # Start the process. As in `_run`, when both the output and the errors
+        # go to the log the errors are written to the output pipe.
+        merge = stdout is None and stderr is None
+        errors = asyncio.subprocess.STDOUT if merge else asyncio.subprocess.PIPE
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            env=self._env,
+            cwd=self._cwd,
+            stdin=stdin,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=errors,
+        )
+
+        # Process the data coming from the command till we reach the end of
+        # all the pipes, and then wait for the process, to avoid a zombie. If
+        # this is cancelled, or fails, we need to kill the process, otherwise
+        # it would keep running without anyone waiting for it.
+        try:
+            buffers = [LineBuffer(log=self._log, stream=stdout)]
+            copies = [self._copy_async(process.stdout, buffers[0])]
+            if not merge:
+                buffers.append(LineBuffer(log=self._log, stream=stderr))
+                copies.append(self._copy_async(process.stderr, buffers[1]))
+            await asyncio.gather(*copies)
+            result = await process.wait()
+        except BaseException:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+
+        # Flush the buffers to complete processing of potential last lines that
+        # don't need with a new line character:
+        for buf in buffers:
+            buf.flush()
+
+        # Return the the exit code of the command:
+        return result
+
+    async def run_async(self, args=[], stdin=None, stdout=None, stderr=None):
+        """
+        Same as `run`, but as a coroutine. This is intended for running several
+        independent commands at the same time, for example:
+
+            await asyncio.gather(lint.run_async(), test.run_async())
+        """
+        # Calculate the complete list of arguments:
+        args = self._args(args)
+
+        # Open the input and output files and run the process:
+        with self._open(stdin, stdout, stderr) as (stdin, stdout, stderr):
+            return await self._run_async(args, stdin, stdout, stderr)
 
     def check(self, args=[], stdin=None, stdout=None, stderr=None):
         """
@@ -260,31 +503,50 @@ class Command:
         if result != 0:
             raise Exception(f"Command finished with exit code {result}")
 
-    def eval(self, args=[]):
+    def eval(self, args=[], cacheable=False):
         """
         Executes the command with the given arguments and environment and
         working directory given in the constructor. If the command finishes
         with exit code zero then it returns the standard output generated
         by the process. If the command finishes with an exit code other than
         zero it raises an exception.
+
+        If `cacheable` is true the output is saved, and later evaluations of
+        the same arguments with this object return it without running the
+        command again. This is intended for commands that don't have side
+        effects and whose output doesn't change during the build, like
+        `go env GOPATH`.
         """
         # Calculate the complete command line:
         _args = self._args(args)
 
-        # Evaluate the command:
-        command = " ".join(_args)
-        self._log.info(f"Evaluating command '{command}'")
-        process = subprocess.Popen(
+        # Check if there is an output saved from a previous evaluation:
+        if cacheable:
+            key = tuple(_args)
+            output = self._eval_cache.get(key)
+            if output is not None:
+                return output
+
+        # Evaluate the command. The complete command line is only built when
+        # it is needed for the log or for the error message.
+        if _log_enabled(self._log):
+            self._log.info(f"Evaluating command '{' '.join(_args)}'")
+        process = subprocess.run(
             args=_args,
             env=self._env,
             cwd=self._cwd,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
+            check=False,
         )
-        output, _ = process.communicate()
-        result = process.wait()
+        result = process.returncode
         if result != 0:
             raise Exception(
-                f"Command '{command}' finished with exit code {result}"
+                f"Command '{' '.join(_args)}' finished with exit code {result}"
             )
-        return output.decode("utf-8")
+        output = process.stdout.decode("utf-8")
+
+        # Save the output if the evaluation can be cached:
+        if cacheable:
+            self._eval_cache[key] = output
+        return output